@@ -0,0 +1,23 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+# _checksum.pyx
+# Optional compiled checksum for the Blue Robotics 'Ping' binary message protocol
+# (built with BRPING_CYTHON=1, see setup.py)
+
+
+## Sum the first 'length' bytes of 'buf', truncated to 16 bits
+# @param buf: bytes-like object
+# @param length: number of bytes to sum
+# @return the 16 bit checksum
+def checksum16(const unsigned char[::1] buf, Py_ssize_t length):
+    cdef Py_ssize_t i
+    cdef unsigned int total = 0
+
+    if length > buf.shape[0]:
+        length = buf.shape[0]
+
+    with nogil:
+        for i in range(length):
+            total += buf[i]
+
+    return total & 0xFFFF
@@ -4,10 +4,43 @@
 # Python implementation of the Blue Robotics 'Ping' binary message protocol
 
 import struct
+from functools import lru_cache
 from brping import definitions
+
+try:
+    from brping._checksum import checksum16 as _compiled_checksum
+except ImportError:
+    _compiled_checksum = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# names exported to the brping package
+__all__ = ["PAYLOAD_DICT", "ASCII_MSGS", "VARIABLE_MSGS", "DYNAMIC_MSGS", "PingMessage", "PingParser"]
+
 PAYLOAD_DICT = definitions.payload_dict_all
-ASCII_MSGS = [definitions.COMMON_NACK, definitions.COMMON_ASCII_TEXT]
-VARIABLE_MSGS = [definitions.PING1D_PROFILE, definitions.PING360_DEVICE_DATA, ]
+ASCII_MSGS = frozenset((definitions.COMMON_NACK, definitions.COMMON_ASCII_TEXT))
+VARIABLE_MSGS = frozenset((definitions.PING1D_PROFILE, definitions.PING360_DEVICE_DATA))
+# messages ending in a dynamic length field
+DYNAMIC_MSGS = ASCII_MSGS | VARIABLE_MSGS
+
+# message table indexed directly by message id, None for unknown ids
+# entries are (name, format, field_names, payload_length) tuples
+_msg_table = [None] * (max(PAYLOAD_DICT) + 1)
+for _msg_id, _entry in PAYLOAD_DICT.items():
+    _msg_table[_msg_id] = (_entry["name"], _entry["format"], _entry["field_names"],
+                           _entry["payload_length"])
+
+
+## Get the message table entry of a message id
+# @param msg_id: the message id
+# @return the (name, format, field_names, payload_length) tuple, None for unknown ids
+def _msg_entry(msg_id):
+    if 0 <= msg_id < len(_msg_table):
+        return _msg_table[msg_id]
+    return None
 
 
 class PingMessage(object):
@@ -41,6 +74,24 @@ class PingMessage(object):
     ## number of bytes in a checksum
     CHECKSUM_LENGTH = 2
 
+    # fixed attribute layout, no per-instance __dict__
+    # the payload fields are slots of the per message id subclasses (see _msg_classes)
+    __slots__ = (
+        "start_1", "start_2", "payload_length", "message_id", "src_device_id", "dst_device_id",
+        "request_id", "checksum", "msg_data", "_packed_values", "_packed_data",
+    )
+
+    # the message id of the per message id subclass, None for unknown messages
+    _class_msg_id = None
+
+    # Create an instance of the subclass holding the payload fields of the message id
+    def __new__(cls, msg_id=0, msg_data=None):
+        if cls is PingMessage:
+            if msg_data is not None and len(msg_data) >= _HEADER_LENGTH:
+                msg_id = msg_data[4] | msg_data[5] << 8
+            cls = _msg_classes.get(msg_id, PingMessage)
+        return object.__new__(cls)
+
     ## Messge constructor
     #
     # @par Ex request:
@@ -67,7 +118,17 @@ class PingMessage(object):
     #     start_mm = m.start_mm
     #     length_mm = m.length_mm
     # @endcode
+    #
+    # @note When receiving, the variable length field of profile and device data
+    #  messages (eg. profile_data) is a memoryview into the received buffer, not a
+    #  copy. It keeps that buffer alive, and a bytearray passed as msg_data can not
+    #  be resized while the view exists. Use bytes(m.profile_data) for an
+    #  independent copy. Pickling and copy.deepcopy() store the field as bytes.
     def __init__(self, msg_id=0, msg_data=None):
+        ## The message start bytes
+        self.start_1 = self.START_1
+        self.start_2 = self.START_2
+
         ## The message id
         self.message_id = msg_id
 
@@ -84,6 +145,9 @@ class PingMessage(object):
         ## The raw data buffer for this message
         # update with pack_msg_data()
         self.msg_data = None
+        # The field values msg_data was last packed from, and a copy of the packed bytes
+        self._packed_values = None
+        self._packed_data = None
 
         # Constructor 1: make a pingmessage object from a binary data buffer
         # (for receiving + unpacking)
@@ -95,60 +159,90 @@ class PingMessage(object):
         # id, with field members ready to access and populate
         # (for packing + transmitting)
         else:
-            try:
-                ## The name of this message
-                self.name = PAYLOAD_DICT[self.message_id]["name"]
-
-                ## The field names of this message
-                self.payload_field_names = PAYLOAD_DICT[self.message_id]["field_names"]
-
-                # initialize payload field members
-                for attr in self.payload_field_names:
-                    setattr(self, attr, 0)
-
-                # initialize vector fields
-                if self.message_id in VARIABLE_MSGS:
-                    setattr(self, self.payload_field_names[-1], bytearray())
-
-                ## Number of bytes in the message payload
-                self.update_payload_length()
-
-                ## The struct formatting string for the message payload
-                self.payload_format = self.get_payload_format()
+            entry = _msg_entry(self.message_id)
 
             # TODO handle better here, and catch Constructor 1 also
-            except KeyError as e:
+            if entry is None:
                 print("message id not recognized:", self.message_id, msg_data)
-                raise e
+                raise KeyError(self.message_id)
+
+            # initialize payload field members
+            field_names = entry[2]
+            for attr in field_names:
+                setattr(self, attr, 0)
+
+            # initialize vector fields
+            if self.message_id in VARIABLE_MSGS:
+                setattr(self, field_names[-1], bytearray())
+
+            ## Number of bytes in the message payload
+            self.update_payload_length()
+
+    ## Pickle and copy support
+    # the per message id subclass is looked up again by id when unpickling,
+    #  as message names (and so subclass names) are not unique across devices
+    def __reduce__(self):
+        return _new_message, (self._class_msg_id,), self.__getstate__()
+
+    ## Pickle and copy support
+    # @return (None, slot values), with the zero-copy memoryview fields as bytes
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, "__slots__", ()):
+                if hasattr(self, attr):
+                    value = getattr(self, attr)
+                    state[attr] = bytes(value) if isinstance(value, memoryview) else value
+        return None, state
+
+    ## The name of this message
+    @property
+    def name(self):
+        return self._table_entry()[0]
+
+    ## The field names of this message
+    @property
+    def payload_field_names(self):
+        return self._table_entry()[2]
+
+    ## The struct formatting string for the message payload
+    @property
+    def payload_format(self):
+        return self.get_payload_format()
+
+    # The message table entry of this message, shared by all messages with its id
+    def _table_entry(self):
+        entry = _msg_entry(self.message_id)
+        if entry is None:
+            raise AttributeError(f'unknown message id: {self.message_id}')
+        return entry
 
     ## Pack object attributes into self.msg_data (bytearray)
     # @return self.msg_data
+    # @note while the message fields are unchanged, the same buffer is returned
+    #  again (eg. when resending a request), it is repacked if it was modified
     def pack_msg_data(self):
         # necessary for variable length payloads
         # update using current contents for the variable length field
         self.update_payload_length()
 
-        # Prepare struct packing format string
-        msg_format = self.ENDIANNESS + self.HEADER_FORMAT + self.get_payload_format()
+        # Nothing changed since the last pack (eg. resending the same request),
+        # neither the fields nor the packed buffer, the buffer and checksum are still valid
+        values = _packers[self.message_id](self)
+        if values == self._packed_values and self.msg_data == self._packed_data:
+            return self.msg_data
 
-        # Prepare complete list of field names (header + payload)
-        attrs = self.HEADER_FIELD_NAMES + PAYLOAD_DICT[self.message_id]["field_names"]
+        # Precompiled struct for the header + payload
+        msg_struct = _message_struct(self.message_id, self.payload_length)
 
-        # Prepare iterable ordered list of values to pack
-        values = []
-        for attr in attrs:
-            # this is a hack for requests
-            if attr == "message_id" and self.request_id is not None:
-                values.append(self.request_id)
-            else:
-                values.append(getattr(self, attr))
-
-        # Pack message contents into bytearray
-        self.msg_data = bytearray(struct.pack(msg_format, *values))
+        # Pack message contents into a preallocated bytearray
+        self.msg_data = bytearray(msg_struct.size + _CHECKSUM_LENGTH)
+        msg_struct.pack_into(self.msg_data, 0, *values)
 
-        # Update and append checksum
-        self.msg_data += bytearray(struct.pack(self.ENDIANNESS + self.CHECKSUM_FORMAT,
-                                               self.update_checksum()))
+        # Update and fill in checksum
+        _CHECKSUM_STRUCT.pack_into(self.msg_data, msg_struct.size, self.update_checksum())
+        self._packed_values = values
+        self._packed_data = bytes(self.msg_data)
 
         return self.msg_data
 
@@ -156,32 +250,38 @@ class PingMessage(object):
     # @Returns True if successful, False otherwise
     def unpack_msg_data(self, msg_data):
         self.msg_data = msg_data
+        self._packed_values = None
+        self._packed_data = None
 
-        header = struct.unpack(self.ENDIANNESS + self.HEADER_FORMAT,
-                               self.msg_data[0:self.HEADER_LENGTH])
+        header = _HEADER_STRUCT.unpack_from(self.msg_data, 0)
 
-        for i, attr in enumerate(self.HEADER_FIELD_NAMES):
-            setattr(self, attr, header[i])
+        (self.start_1, self.start_2, self.payload_length, self.message_id,
+         self.src_device_id, self.dst_device_id) = header
 
-        ## The name of this message
-        try:
-            self.name = PAYLOAD_DICT[self.message_id]["name"]
-        except KeyError:
+        entry = _msg_entry(self.message_id)
+        if entry is None:
             print(f'unknown message:', self.message_id)
             return False
 
-        ## The field names of this message
-        self.payload_field_names = PAYLOAD_DICT[self.message_id]["field_names"]
+        field_names = entry[2]
 
         if self.payload_length > 0:
-            ## The struct formatting string for the message payload
-            self.payload_format = self.get_payload_format()
-
             # Extract payload
             try:
-                payload = struct.unpack(self.ENDIANNESS + self.payload_format,
-                                        self.msg_data[self.HEADER_LENGTH:
-                                                      self.HEADER_LENGTH + self.payload_length])
+                payload_end = _HEADER_LENGTH + self.payload_length
+                if self.message_id in VARIABLE_MSGS:
+                    # unpack the static fields only, and keep the variable length
+                    #  data as a zero-copy view into msg_data
+                    msg_struct = _compile_variable_struct(self.message_id, 0)
+                    if msg_struct.size > payload_end:
+                        raise struct.error(f'payload length {self.payload_length} does not match format')
+                    values = (msg_struct.unpack_from(self.msg_data, 0) +
+                              (memoryview(self.msg_data)[msg_struct.size:payload_end],))
+                else:
+                    msg_struct = _message_struct(self.message_id, self.payload_length)
+                    if msg_struct.size != payload_end:
+                        raise struct.error(f'payload length {self.payload_length} does not match format')
+                    values = msg_struct.unpack_from(self.msg_data, 0)
             except Exception as e:
                 print("error unpacking payload:", e)
                 print(f'header: {header}, format: {self.ENDIANNESS + self.payload_format}')
@@ -191,25 +291,28 @@ class PingMessage(object):
                 #                                             self.HEADER_LENGTH + self.payload_length]))
                 print('payload_format:', self.payload_format)
             else:  # only use payload if didn't raise exception
-                for i, attr in enumerate(self.payload_field_names):
-                    try:
-                        setattr(self, attr, payload[i])
-                    # empty trailing variable data field
-                    except IndexError as e:
-                        if self.message_id in VARIABLE_MSGS:
-                            setattr(self, attr, bytearray())
+                if len(values) == len(self.HEADER_FIELD_NAMES) + len(field_names):
+                    _unpackers[self.message_id](self, values)
+                else:
+                    payload = values[len(self.HEADER_FIELD_NAMES):]
+                    for attr, value in zip(field_names, payload):
+                        setattr(self, attr, value)
+
+                    # empty trailing dynamic length field (eg. a nack without text),
+                    #  which the struct format leaves out
+                    if len(payload) < len(field_names) and self.message_id in DYNAMIC_MSGS:
+                        setattr(self, field_names[-1], b'')
 
         # Extract checksum
-        checksum_start = self.HEADER_LENGTH + self.payload_length
-        checksum_end = checksum_start + self.CHECKSUM_LENGTH
+        checksum_start = _HEADER_LENGTH + self.payload_length
         # try-except?
-        self.checksum = struct.unpack(self.ENDIANNESS + self.CHECKSUM_FORMAT,
-                                      self.msg_data[checksum_start:checksum_end])[0]
+        self.checksum = _CHECKSUM_STRUCT.unpack_from(self.msg_data, checksum_start)[0]
         return True
 
     ## Calculate the checksum from the internal bytearray self.msg_data
+    # the checksum is the 16 bit truncated sum of all header and payload bytes
     def calculate_checksum(self):
-        return sum(self.msg_data[0:self.HEADER_LENGTH + self.payload_length])
+        return _checksum(self.msg_data, _HEADER_LENGTH + self.payload_length)
 
     ## Update the object checksum value
     # @return the object checksum value
@@ -225,59 +328,88 @@ class PingMessage(object):
     ## Update the payload_length attribute with the **current** payload length,
     #  including dynamic length fields (if present)
     def update_payload_length(self):
-        if self.message_id in VARIABLE_MSGS or self.message_id in ASCII_MSGS:
+        if self.message_id in DYNAMIC_MSGS:
             # The last field (self.payload_field_names[-1]) is always the
             #  single dynamic-length field
             self.payload_length = (
-                PAYLOAD_DICT[self.message_id]["payload_length"] +
+                _msg_table[self.message_id][3] +
                 len(getattr(self, self.payload_field_names[-1]))
             )
         else:
-            self.payload_length = PAYLOAD_DICT[self.message_id]["payload_length"]
+            self.payload_length = _msg_table[self.message_id][3]
 
     ## Get the python struct formatting string for the message payload
     # @return the payload struct format string
     def get_payload_format(self):
-        extra = '' # assume static (constant) message length
         # handle messages with variable length fields
-        if self.message_id in VARIABLE_MSGS or self.message_id in ASCII_MSGS:
+        if self.message_id in DYNAMIC_MSGS:
             # Subtract static length portion from payload length
-            var_length = self.payload_length - PAYLOAD_DICT[self.message_id]["payload_length"]
-            if var_length > 0:
-                extra = f'{var_length}s'
-            # else variable data portion is empty
+            var_length = self.payload_length - _msg_table[self.message_id][3]
+            return _variable_payload_format(self.message_id, var_length)
+
+        # static (constant) message length
+        return _msg_table[self.message_id][1]
 
-        return PAYLOAD_DICT[self.message_id]["format"] + extra
+    ## Unpack a buffer of back-to-back messages, all with the same static length
+    #  message id, into columns of field values (no PingMessage per message)
+    # @par Ex:
+    # @code
+    # columns = PingMessage.parse_batch(logged_data, PING1D_DISTANCE)
+    # mean_distance = sum(columns["distance"]) / len(columns["distance"])
+    # @endcode
+    #
+    # @param buf: bytes-like object holding only complete messages
+    # @param msg_id: the message id of every message in buf
+    # @return dict of field name (header fields, payload fields and "checksum")
+    #  to a tuple with the value of that field in each message
+    # @note checksums are returned, but not verified
+    @staticmethod
+    def parse_batch(buf, msg_id):
+        if msg_id not in _compiled:
+            raise ValueError(f'message id {msg_id} is not a static length message')
+
+        batch_struct = _batch_struct(msg_id)
+        if len(buf) % batch_struct.size:
+            raise ValueError(f'buffer length {len(buf)} is not a multiple of the '
+                             f'message length {batch_struct.size}')
+
+        field_names = (PingMessage.HEADER_FIELD_NAMES + _msg_table[msg_id][2] +
+                       ("checksum",))
+        columns = dict(zip(field_names, zip(*batch_struct.iter_unpack(buf))))
+        if not columns:  # empty buffer
+            return {name: () for name in field_names}
+
+        if any(message_id != msg_id for message_id in columns["message_id"]):
+            raise ValueError(f'buffer holds messages other than {msg_id}')
+
+        return columns
 
     ## Dump object into string representation
     # @return string representation of the object
     def __repr__(self):
-        header_string = "Header:"
-        for attr in self.HEADER_FIELD_NAMES:
-            header_string += " " + attr + ": " + str(getattr(self, attr))
+        header_string = "Header: " + " ".join(
+            f"{attr}: {getattr(self, attr)}" for attr in self.HEADER_FIELD_NAMES)
 
         if self.payload_length == 0:  # this is a hack/guard for empty body requests
             payload_string = ""
         else:
-            payload_string = "Payload:"
+            field_names = _msg_table[self.message_id][2]
 
             # handle variable length messages
             if self.message_id in VARIABLE_MSGS:
-
                 # static fields are handled as usual
-                for attr in PAYLOAD_DICT[self.message_id]["field_names"][:-1]:
-                    payload_string += "\n  - " + attr + ": " + str(getattr(self, attr))
+                fields = [f"{attr}: {getattr(self, attr)}" for attr in field_names[:-1]]
 
                 # the variable length field is always the last field
-                attr = PAYLOAD_DICT[self.message_id]["field_names"][-1:][0]
-
-                # format this field as a list of hex values
+                # format this field as hex digits
                 #  (rather than a string if we did not perform this handling)
-                payload_string += f"\n  - {attr}: {[hex(item) for item in getattr(self, attr)]}"
+                attr = field_names[-1]
+                fields.append(f"{attr}: {memoryview(getattr(self, attr)).hex()}")
 
             else:  # handling of static length messages and text messages
-                for attr in PAYLOAD_DICT[self.message_id]["field_names"]:
-                    payload_string += "\n  - " + attr + ": " + str(getattr(self, attr))
+                fields = [f"{attr}: {getattr(self, attr)}" for attr in field_names]
+
+            payload_string = "Payload:" + "".join("\n  - " + field for field in fields)
 
         representation = (
             "\n\n--------------------------------------------------\n"
@@ -290,6 +422,162 @@ class PingMessage(object):
         return representation
 
 
+# header and checksum lengths, for the length arithmetic in the hot paths
+_HEADER_LENGTH = PingMessage.HEADER_LENGTH
+_CHECKSUM_LENGTH = PingMessage.CHECKSUM_LENGTH
+
+## Precompiled header struct
+_HEADER_STRUCT = struct.Struct(PingMessage.ENDIANNESS + PingMessage.HEADER_FORMAT)
+
+## Precompiled checksum struct
+_CHECKSUM_STRUCT = struct.Struct(PingMessage.ENDIANNESS + PingMessage.CHECKSUM_FORMAT)
+
+
+## Generate the functions that get and set the struct ordered values of a message
+# the attribute accesses are spelled out, instead of looping over getattr/setattr
+# (this also measures faster than an operator.attrgetter over the same names,
+#  and takes care of the request_id hack without a per-field branch)
+# @param field_names: the payload field names of the message
+# @param dynamic: True if the last field is dynamic length data
+# @return (pack_values(self) -> tuple, unpack_values(self, values))
+def _generate_accessors(field_names, dynamic=False):
+    for name in field_names:
+        if not name.isidentifier():
+            raise ValueError(f'invalid field name: {name!r}')
+
+    payload = "".join(f", self.{name}" for name in field_names)
+    pack_payload = payload
+    if dynamic:
+        # received data is a memoryview, which struct only packs as bytes
+        # the copy also keeps a later in-place edit of a bytearray field from
+        #  comparing equal to the values of the last pack
+        pack_payload = "".join(f", self.{name}" for name in field_names[:-1])
+        pack_payload += f", bytes(self.{field_names[-1]})"
+
+    source = (
+        "def pack_values(self):\n"
+        # this is a hack for requests
+        "    message_id = self.message_id if self.request_id is None else self.request_id\n"
+        "    return (START_1, START_2, self.payload_length, message_id,\n"
+        f"            self.src_device_id, self.dst_device_id{pack_payload})\n"
+        "\n"
+        "def unpack_values(self, values):\n"
+        # the header fields are already set
+        f"    (_, _, _, _, _, _{payload}) = values\n"
+    )
+    namespace = {"START_1": PingMessage.START_1, "START_2": PingMessage.START_2}
+    exec(source, namespace)
+    return namespace["pack_values"], namespace["unpack_values"]
+
+
+_packers = {}
+_unpackers = {}
+# one PingMessage subclass per message id, with slots for only its own payload fields
+_msg_classes = {}
+for _msg_id, _entry in PAYLOAD_DICT.items():
+    _msg_classes[_msg_id] = type("PingMessage_" + _entry["name"], (PingMessage,),
+                                 {"__slots__": tuple(_entry["field_names"]),
+                                  "_class_msg_id": _msg_id})
+    _packers[_msg_id], _unpackers[_msg_id] = _generate_accessors(_entry["field_names"],
+                                                                 _msg_id in DYNAMIC_MSGS)
+
+
+## Create an empty message of the PingMessage subclass of a message id, for unpickling
+# @param msg_id: the message id, None for a plain PingMessage
+# @return the new message, without any attribute set
+def _new_message(msg_id):
+    return object.__new__(_msg_classes.get(msg_id, PingMessage))
+
+
+## Sum the first 'length' bytes of 'buf', truncated to 16 bits
+# sum() over a bytes-like slice runs the whole loop in C
+def _checksum(buf, length):
+    return sum(buf[0:length]) & 0xFFFF
+
+
+if _compiled_checksum is not None:
+    # built with BRPING_CYTHON, no call overhead worth avoiding for short messages
+    _checksum = _compiled_checksum
+elif numba is not None:
+    ## Below this many bytes, the numba call overhead outweighs the jitted loop
+    _NUMBA_CHECKSUM_MIN_LENGTH = 64
+
+    # a plain byte loop: llvm vectorizes it, a hand written SWAR version was no faster
+    @numba.njit(cache=True)
+    def _checksum_u16(buf, length):
+        total = 0
+        for i in range(length):
+            total += buf[i]
+        return total & 0xFFFF
+
+    _python_checksum = _checksum
+
+    ## Sum the first 'length' bytes of 'buf', truncated to 16 bits
+    # long messages (profiles, device data) are summed in a jitted loop
+    def _checksum(buf, length):
+        if length < _NUMBA_CHECKSUM_MIN_LENGTH:
+            return _python_checksum(buf, length)
+        # the jitted loop is not bounds checked, stop at the end of buf like a slice does
+        length = min(length, len(buf))
+        # bytes and bytearray are passed straight through, without a numpy.frombuffer view
+        return _checksum_u16(buf, length)
+
+
+## Precompiled header + payload structs for static length messages, by message id
+_compiled = {
+    msg_id: struct.Struct(PingMessage.ENDIANNESS + PingMessage.HEADER_FORMAT + entry["format"])
+    for msg_id, entry in PAYLOAD_DICT.items()
+    if msg_id not in DYNAMIC_MSGS
+}
+
+
+## Get the payload struct format string of a dynamic length message
+# results are cached by (msg_id, var_length), as the same lengths tend to repeat
+# @param msg_id: the message id
+# @param var_length: the number of bytes in the dynamic length field
+# @return the payload struct format string
+@lru_cache(maxsize=256)
+def _variable_payload_format(msg_id, var_length):
+    extra = f'{var_length}s' if var_length > 0 else ''  # else variable data portion is empty
+    return _msg_table[msg_id][1] + extra
+
+
+## Compile the header + payload struct of a dynamic length message
+# results are cached by (msg_id, var_length), as the same lengths tend to repeat
+# @param msg_id: the message id
+# @param var_length: the number of bytes in the dynamic length field
+# @return the compiled struct.Struct
+@lru_cache(maxsize=256)
+def _compile_variable_struct(msg_id, var_length):
+    return struct.Struct(PingMessage.ENDIANNESS + PingMessage.HEADER_FORMAT +
+                         _variable_payload_format(msg_id, var_length))
+
+
+## Compile the header + payload + checksum struct of a static length message,
+#  to unpack back-to-back messages with
+# @param msg_id: the message id
+# @return the compiled struct.Struct
+@lru_cache(maxsize=None)
+def _batch_struct(msg_id):
+    return struct.Struct(_compiled[msg_id].format + PingMessage.CHECKSUM_FORMAT)
+
+
+## Get the precompiled header + payload struct for a message
+# @param msg_id: the message id
+# @param payload_length: the total payload length of the message
+# @return the compiled struct.Struct
+def _message_struct(msg_id, payload_length):
+    msg_struct = _compiled.get(msg_id)
+    if msg_struct is None:
+        msg_struct = _compile_variable_struct(msg_id, payload_length - _msg_table[msg_id][3])
+    return msg_struct
+
+
+# message start bytes, for comparisons in the per-byte parser
+_START_1 = PingMessage.START_1
+_START_2 = PingMessage.START_2
+
+
 class PingParser(object):
     ''' A class to digest a serial stream and decode PingMessages. '''
     (PARSE_ERROR,        # -1  Error occurred while parsing
@@ -305,9 +593,10 @@ class PingParser(object):
      WAIT_PAYLOAD,       #     Waiting for the last byte of the payload to come in
      WAIT_CHECKSUM_L,    #     Waiting for the checksum low byte
      WAIT_CHECKSUM_H,    #     Waiting for the checksum high byte
-    ) = range(-1, 12)
+     SKIP_MESSAGE,       #     Skipping the rest of an unknown message (unverified parsing only)
+    ) = range(-1, 13)
 
-    def __init__(self):
+    def __init__(self, verify=True):
         self.buf = bytearray()
         self.state = self.WAIT_START
         self.payload_length = 0  # remaining for the message being parsed
@@ -315,26 +604,30 @@ class PingParser(object):
         self.errors = 0
         self.parsed = 0
         self.rx_msg = None  # most recently parsed message
+        # verify message checksums, can be disabled for trusted links
+        self.verify = verify
 
-        self._parse_byte = [
+        # state handlers, indexed directly by state (there is no state 0)
+        self._parse_byte = (None,) + tuple(
             getattr(self, byte_key) for byte_key in (
                 'wait_start', 'wait_header', 'wait_length_l', 'wait_length_h',
                 'wait_msg_id_l', 'wait_msg_id_h', 'wait_src_id', 'wait_dst_id',
-                'wait_payload', 'wait_checksum_l', 'wait_checksum_h', 
+                'wait_payload', 'wait_checksum_l', 'wait_checksum_h', 'skip_message',
             )
-        ]
+        )
 
     def progress(self, msg_byte):
         self.buf.append(msg_byte)
         self.state += 1
 
     def wait_start(self, msg_byte):
-        self.buf = bytearray()
-        if msg_byte == ord('B'):
+        if msg_byte == _START_1:
+            # a fresh buffer per message, as the last one is kept by rx_msg.msg_data
+            self.buf = bytearray()
             self.progress(msg_byte)
 
     def wait_header(self, msg_byte):
-        if msg_byte == ord('R'):
+        if msg_byte == _START_2:
             self.progress(msg_byte)
         else:
             self.state = self.WAIT_START
@@ -353,6 +646,23 @@ class PingParser(object):
 
     def wait_msg_id_h(self, msg_byte):
         self.message_id |= (msg_byte << 8)
+
+        # drop unknown messages without buffering the rest of them
+        if self.message_id not in PAYLOAD_DICT:
+            self.message_id = 0
+            self.errors += 1
+            if self.verify:
+                # resume the search for a message start right after the message id
+                self.state = self.WAIT_START
+                self.payload_length = 0
+            else:
+                # without checksums, the contents of the unknown message can not be
+                #  told apart from a message start, so trust its length and skip it:
+                #  source and destination ids, payload and checksum
+                self.state = self.SKIP_MESSAGE
+                self.payload_length += 2 + _CHECKSUM_LENGTH
+            return self.PARSE_ERROR
+
         self.progress(msg_byte)
 
     def wait_src_id(self, msg_byte):
@@ -378,34 +688,164 @@ class PingParser(object):
         self.message_id = 0
 
         self.buf.append(msg_byte)
-        self.rx_msg = PingMessage(msg_data=self.buf)
 
-        if self.rx_msg.verify_checksum():
-            self.parsed += 1
-            return self.NEW_MESSAGE
-        else:
-            self.errors += 1
+        if self._decode(self.buf) is None:
             return self.PARSE_ERROR
+        return self.NEW_MESSAGE
+
+    def skip_message(self, msg_byte):
+        self.payload_length -= 1
+        if self.payload_length == 0: # unknown message skipped
+            self.state = self.WAIT_START
+
+    def _decode(self, frame):
+        ''' Decodes a complete message frame, from 'B' to the checksum.
+
+        Returns the decoded PingMessage, or None if the frame is invalid.
+        '''
+        # verify the checksum before spending time on decoding the message
+        if self.verify and (_checksum(frame, len(frame) - _CHECKSUM_LENGTH) !=
+                            frame[-2] | (frame[-1] << 8)):
+            self.errors += 1
+            return None
+
+        # unknown message ids were already rejected when the header was parsed
+        self.rx_msg = PingMessage(msg_data=frame)
+        self.parsed += 1
+        return self.rx_msg
 
     def parse_byte(self, msg_byte) -> int:
         ''' Feeds the parser a single byte and returns the current parse state.
 
-        'msg_byte' is the byte to parse.
+        'msg_byte' is the byte to parse, as an int (eg. an item of a bytes object).
             If it completes a valid message, returns PingParser.NEW_MESSAGE if
                 the message is valid, else PingParser.PARSE_ERROR.
+            Also returns PingParser.PARSE_ERROR as soon as the message id of
+                an unknown message is received. Without checksum verification,
+                the rest of the unknown message is then skipped.
             The decoded PingMessage will be available in the self.rx_msg
                 attribute until a new message is decoded.
 
         '''
-        if not isinstance(msg_byte, int):
-            msg_byte = ord(msg_byte)
-
-        result = self._parse_byte[self.state - 1](msg_byte)
+        result = self._parse_byte[self.state](msg_byte)
 
         return self.state if result is None else result
 
+    def parse_bytes(self, data) -> list:
+        ''' Feeds the parser a chunk of bytes and returns the messages it completes.
+
+        'data' is a bytes or bytearray object with the bytes to parse.
+            Returns a list of the checksum-verified PingMessages decoded from
+                'data', in order of arrival.
+            The last decoded PingMessage will also be available in the
+                self.rx_msg attribute until a new message is decoded.
+            A trailing partial message is kept, and completed by the next
+                call to parse_bytes or parse_byte.
+
+        Unlike parse_byte, the start of each message is searched for with
+        bytes.find, and each message is sliced out of 'data' in one go.
+        '''
+        # finish skipping an unknown message that was partially received
+        if self.state == self.SKIP_MESSAGE:
+            if len(data) < self.payload_length:
+                self.payload_length -= len(data)
+                return []
+            data = data[self.payload_length:]
+            self.state = self.WAIT_START
+            self.payload_length = 0
+
+        # resume a message that was partially received by a previous call
+        buf = data if self.state == self.WAIT_START else self.buf + data
+
+        messages = []
+        buf_length = len(buf)
+        start = 0
+        skip_length = 0  # of an unknown message that continues past buf
+        while True:
+            found = buf.find(b"BR", start)
+            if found == -1:
+                # a trailing 'B' may be the start of the next message, unless it
+                #  was the last byte of a message that was just consumed
+                if start < buf_length and buf[-1] == _START_1:
+                    start = buf_length - 1
+                else:
+                    start = buf_length
+                break
+            start = found
+
+            # drop unknown messages like parse_byte does
+            if buf_length - start >= 6 and buf[start + 4] | (buf[start + 5] << 8) not in PAYLOAD_DICT:
+                self.errors += 1
+                if self.verify:
+                    # resume the search right after the message id
+                    start += 6
+                    continue
+
+                # without checksums, trust the length and skip the whole message
+                start += (_HEADER_LENGTH + (buf[start + 2] | (buf[start + 3] << 8)) +
+                          _CHECKSUM_LENGTH)
+                if start > buf_length:
+                    skip_length = start - buf_length
+                    start = buf_length
+                    break
+                continue
+
+            if buf_length - start < _HEADER_LENGTH:
+                break
+
+            payload_length = buf[start + 2] | (buf[start + 3] << 8)
+            end = start + _HEADER_LENGTH + payload_length + _CHECKSUM_LENGTH
+            if end > buf_length:
+                break
+
+            rx_msg = self._decode(buf[start:end])
+            if rx_msg is not None:
+                messages.append(rx_msg)
+
+            start = end
+
+        self._resume(buf[start:])
+        if skip_length:
+            self.state = self.SKIP_MESSAGE
+            self.payload_length = skip_length
+
+        return messages
+
+    def _resume(self, partial):
+        ''' Sets the byte-wise parse state to continue from a partial message.
+
+        'partial' is the beginning of a message, starting with 'B', or empty.
+        '''
+        self.buf = bytearray(partial)
+        partial_length = len(partial)
+        self.payload_length = 0
+        self.message_id = 0
+
+        if partial_length > 2:
+            self.payload_length = partial[2]
+        if partial_length > 3:
+            self.payload_length |= partial[3] << 8
+        if partial_length > 4:
+            self.message_id = partial[4]
+        if partial_length > 5:
+            self.message_id |= partial[5] << 8
+
+        if partial_length < _HEADER_LENGTH:
+            self.state = self.WAIT_START + partial_length
+        else:
+            remaining = _HEADER_LENGTH + self.payload_length - partial_length
+            if remaining > 0:
+                self.payload_length = remaining
+                self.state = self.WAIT_PAYLOAD
+            else:
+                self.payload_length = 0
+                self.state = self.WAIT_CHECKSUM_L - remaining
+
 
 if __name__ == "__main__":
+    import copy
+    import pickle
+
     # Hand-written data buffers for testing and verification
     test_protocol_version_buf = bytearray([
         0x42,
@@ -487,3 +927,121 @@ if __name__ == "__main__":
     else:
         print("fail:", result)
         exit(1)
+
+    # Both messages in a single chunk
+    print("\n---Testing parse_bytes---\n")
+    rx_msgs = p.parse_bytes(test_protocol_version_buf + test_profile_buf)
+
+    if [msg.message_id for msg in rx_msgs] == [definitions.COMMON_PROTOCOL_VERSION, definitions.PING1D_PROFILE]:
+        for msg in rx_msgs:
+            print(msg)
+    else:
+        print("fail:", rx_msgs)
+        exit(1)
+
+    # Messages split across parse_bytes calls, and finished with parse_byte
+    print("\n---Testing split messages---\n")
+    # a profile that ends with 'B', which must not be kept as the start of a message
+    msg = PingMessage(definitions.PING1D_PROFILE)
+    for length in range(1, 1000):
+        msg.profile_data = bytearray([0xff] * length)
+        if msg.pack_msg_data()[-1] == PingMessage.START_1:
+            break
+
+    p = PingParser()
+    split_msgs = p.parse_bytes(msg.msg_data)
+    for byte in test_protocol_version_buf:
+        result = p.parse_byte(byte)
+    if result is p.NEW_MESSAGE:
+        split_msgs.append(p.rx_msg)
+
+    split_msgs += p.parse_bytes(test_profile_buf[:20])
+    split_msgs += p.parse_bytes(test_profile_buf[20:] + test_protocol_version_buf[:5])
+    for byte in test_protocol_version_buf[5:]:
+        result = p.parse_byte(byte)
+
+    if (len(split_msgs) == 3 and result is p.NEW_MESSAGE and p.parsed == 4 and p.errors == 0 and
+            bytes(split_msgs[0].profile_data) == bytes(msg.profile_data)):
+        print(p.rx_msg)
+    else:
+        print("fail:", split_msgs, result, p.parsed, p.errors)
+        exit(1)
+
+    # Back-to-back static length messages unpacked into columns
+    print("\n---Testing parse_batch---\n")
+    columns = PingMessage.parse_batch(test_protocol_version_buf * 2, definitions.COMMON_PROTOCOL_VERSION)
+
+    if (columns["version_major"] == (1, 1) and columns["reserved"] == (99, 99) and
+            columns["src_device_id"] == (77, 77) and columns["checksum"] == (0x226, 0x226)):
+        print(columns)
+    else:
+        print("fail:", columns)
+        exit(1)
+
+    # A corrupt checksum is only accepted when verification is disabled
+    print("\n---Testing verify=False---\n")
+    corrupt_buf = test_protocol_version_buf[:-1] + bytearray([0xff])
+
+    verified_msgs = PingParser().parse_bytes(corrupt_buf)
+    unverified_msgs = PingParser(verify=False).parse_bytes(corrupt_buf)
+    if not verified_msgs and len(unverified_msgs) == 1 and unverified_msgs[0].version_minor == 2:
+        print(unverified_msgs[0])
+    else:
+        print("fail:", verified_msgs, unverified_msgs)
+        exit(1)
+
+    # Without checksums, an unknown message is skipped whole, so a message start in
+    #  its payload is not mistaken for a message
+    print("\n---Testing unknown message with verify=False---\n")
+    msg = PingMessage(definitions.COMMON_PROTOCOL_VERSION)
+    msg.version_major = 9
+    unknown_buf = bytearray(b"BR") + struct.pack("<HHBB", len(msg.pack_msg_data()), 4321, 1, 2)
+    unknown_buf += msg.msg_data
+    unknown_buf += struct.pack("<H", sum(unknown_buf) & 0xFFFF)
+    stream = unknown_buf + test_protocol_version_buf
+
+    p = PingParser(verify=False)
+    unverified_msgs = p.parse_bytes(stream)
+    p_split = PingParser(verify=False)
+    unverified_msgs += p_split.parse_bytes(stream[:10]) + p_split.parse_bytes(stream[10:])
+    p_byte = PingParser(verify=False)
+    for byte in stream:
+        if p_byte.parse_byte(byte) is p_byte.NEW_MESSAGE:
+            unverified_msgs.append(p_byte.rx_msg)
+
+    if ([msg.version_major for msg in unverified_msgs] == [1, 1, 1] and
+            p.errors == p_split.errors == p_byte.errors == 1):
+        print(unverified_msgs[0])
+    else:
+        print("fail:", unverified_msgs)
+        exit(1)
+
+    # Modified fields and buffers are repacked, not served from the last pack
+    print("\n---Testing repack---\n")
+    msg = PingMessage(definitions.PING1D_PROFILE)
+    msg.profile_data = bytearray(b"hello")
+    packed = bytes(msg.pack_msg_data())
+    msg.profile_data[0] = ord("j")
+    edited = bytes(msg.pack_msg_data())
+    msg.msg_data[6] = 99
+    restored = bytes(msg.pack_msg_data())
+
+    if edited != packed and edited.endswith(b"jello" + edited[-2:]) and restored == edited and msg.verify_checksum():
+        print(msg)
+    else:
+        print("fail:", packed, edited, restored)
+        exit(1)
+
+    # Messages survive a pickle round trip (eg. through a multiprocessing queue) and
+    #  a deep copy, including the zero-copy variable length field
+    print("\n---Testing pickle---\n")
+    msg = PingMessage(definitions.COMMON_PROTOCOL_VERSION)
+    msg.version_major = 1
+    msg.pack_msg_data()
+    for msg in (msg, *rx_msgs):
+        for unpickled in (pickle.loads(pickle.dumps(msg)), copy.deepcopy(msg)):
+            if type(unpickled) is type(msg) and bytes(unpickled.pack_msg_data()) == bytes(msg.msg_data):
+                print(unpickled)
+            else:
+                print("fail:", unpickled)
+                exit(1)
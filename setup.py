@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 
+import os
 from setuptools import setup, find_packages
 
+# Optionally compile the message/parser module with Cython (pure python mode),
+# along with the compiled checksum
+# eg. BRPING_CYTHON=1 python setup.py install
+ext_modules = []
+if os.environ.get("BRPING_CYTHON"):
+    from Cython.Build import cythonize
+    ext_modules = cythonize(["brping/pingmessage.py", "brping/_checksum.pyx"], language_level=3)
+
 long_description = """
 Python library for the Blue Robotics ping-protocol, and devices that implement it.
 
@@ -19,6 +28,8 @@ setup(name='bluerobotics-ping',
       author_email='support@bluerobotics.com',
       url='https://www.bluerobotics.com',
       packages=find_packages(), install_requires=['pyserial', 'future'],
+      ext_modules=ext_modules,
+      extras_require={'numba': ['numba']},
       classifiers=[
           "Programming Language :: Python",
           "License :: OSI Approved :: MIT License",
@@ -22,9 +22,7 @@ class PingClient(object):
     ## Digest incoming client data
     # @return None
     def parse(self, data):
-        for b in bytearray(data):
-            if self.parser.parse_byte(b) == PingParser.NEW_MESSAGE:
-                self.rx_msgs.append(self.parser.rx_msg)
+        self.rx_msgs.extend(self.parser.parse_bytes(data))
 
     ## Dequeue a message received from client
     # @return None: if there are no comms in the queue